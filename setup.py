@@ -1,14 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import pathlib
+import re
+
 from setuptools import setup, find_packages
 
+# the version is defined once in the module, it is also part of the fingerprints of the stored skeleton files.
+# it is parsed instead of imported, as the dependencies of the module may not be installed yet
+version = re.search(r'^__version__ = "([^"]+)"',
+                    (pathlib.Path(__file__).parent / 'src' / 'cython2skeleton.py').read_text(), re.M).group(1)
+
 setup(
     name='Cython2Skeleton',
-    version='0.1.0',
+    version=version,
     url='https://github.com/steffen-sanwald/cython2skeleton.git',
     author='Steffen Sanwald',
     description='Quickly gather highlevel insights into cython compiled executable/shared library.',
     packages=find_packages(),
-    install_requires=['fire', 'binary2strings'],
+    python_requires='>=3.10',
+    install_requires=['fire', 'binary2strings', 'pyahocorasick'],
 )
\ No newline at end of file
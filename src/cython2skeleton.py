@@ -1,12 +1,22 @@
 from __future__ import annotations
-import queue
+import mmap
+import operator
+import os
+import re
+from collections import deque
 from dataclasses import dataclass
 from enum import IntEnum
-from typing import Optional
+from typing import Iterator, Optional, TextIO
 
+import ahocorasick
 import fire as fire
 import binary2strings as b2s
 
+# single source of the version, read by setup.py. Bump it on every release, as it invalidates stored skeletons
+__version__ = "0.1.0"
+
+_NAME_KEY = operator.attrgetter("name")
+
 
 class PythonEntityType(IntEnum):
     """
@@ -26,10 +36,12 @@ class PythonEntityType(IntEnum):
     ROOT_TRAVERSAL_OBJECT = 99
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class PythonEntity:
     """
     Represents a python entity, such as a class, a function, a method, a variable, etc.
+    Uses slots instead of a per instance __dict__, as large binaries produce trees with thousands of entities.
+    Equality and ordering are implemented below and only consider the name (and type)
     """
     name: str
     type: PythonEntityType
@@ -82,6 +94,24 @@ class Cython2Skeleton:
     ELF_KEYWORDS = ["glibc", ".so."]
 
     COMMENT_KEYWORDS = [":param", ":return", "@param", "@return"]
+    # symbol names that mark their parent as a class. The keys of the symbol tree are split at the dots,
+    # so a set lookup of the whole key is sufficient
+    CONSTRUCTOR_NAMES = frozenset(["__init__", "__new__"])
+
+    # each keyword list compiled into a single case insensitive alternation, so a string is scanned only once
+    _CYTHON_KEYWORDS_RE = re.compile("|".join(map(re.escape, CYTHON_KEYWORDS)), re.IGNORECASE)
+    _ELF_KEYWORDS_RE = re.compile("|".join(map(re.escape, ELF_KEYWORDS)), re.IGNORECASE)
+    _COMMENT_KEYWORDS_RE = re.compile("|".join(map(re.escape, COMMENT_KEYWORDS)), re.IGNORECASE)
+    # \w is exactly str.isalnum() plus the underscore
+    _INVALID_SYMBOL_CHAR_RE = re.compile(r"[^\w.]")
+    _VERSION_RE = re.compile(r"[vV]?[\d.]+\Z")
+
+    # files larger than this are mapped into memory and scanned window by window instead of being read at once
+    MMAP_WINDOW_SIZE = 16 * 1024 * 1024
+    # a run of NUL bytes can't be part of an ascii, utf-8 or utf-16 string, so windows are split after it
+    WINDOW_SEPARATOR = b"\x00" * 4
+    # buffer size used when writing the skeleton file
+    WRITE_BUFFER_SIZE = 1024 * 1024
 
     def __init__(self, filepath: str, only_interesting: bool = False, min_chars: int = 5):
         """
@@ -90,6 +120,7 @@ class Cython2Skeleton:
         :param filepath: the path to the cython compiled file
         """
         self._filepath = filepath
+        self._buffer = None
         self._skeleton = None
         self._comments = None
         self._shared_libs = None
@@ -98,21 +129,70 @@ class Cython2Skeleton:
         self._only_interesting = only_interesting
         self._min_chars = min_chars
 
+    def _get_buffer(self) -> bytes | mmap.mmap:
+        """
+        Get the content of the file. It is read only once and cached, until close() is called.
+        Small files are read into a bytes object, larger files are memory mapped
+        """
+        if self._buffer is None:
+            with open(self._filepath, "rb") as f:
+                if os.fstat(f.fileno()).st_size <= self.MMAP_WINDOW_SIZE:
+                    self._buffer = f.read()
+                else:
+                    # the mapping stays valid after the file is closed
+                    self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        self._buffer.madvise(mmap.MADV_SEQUENTIAL)
+        return self._buffer
+
+    def _read_buffers(self) -> Iterator[bytes]:
+        """
+        Yield the content of the file in chunks that can be passed to binary2strings.
+        Small files are yielded at once. Memory mapped files are yielded window by window,
+        so the whole file is never copied into a single bytes object.
+        Each window ends after a run of NUL bytes, so no string is split between two windows.
+        """
+        buffer = self._get_buffer()
+        if isinstance(buffer, bytes):
+            yield buffer
+            return
+        size = len(buffer)
+        start = 0
+        while start < size:
+            end = buffer.find(self.WINDOW_SEPARATOR, start + self.MMAP_WINDOW_SIZE)
+            end = size if end == -1 else end + len(self.WINDOW_SEPARATOR)
+            # binary2strings only accepts bytes, slicing copies just the current window
+            yield buffer[start:end]
+            start = end
+
+    def close(self):
+        """
+        Release the cached content of the file, unmapping it if it was memory mapped.
+        The file is read again, if it is needed afterwards
+        """
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = None
+
     def _get_strings_from_file(self) -> list[str]:
         """
         Get all strings from the file using python's binary2strings library
         """
-        with open(self._filepath, "rb") as f:
-            buffer = f.read()
+        seen = set()
+        result = []
+        for buffer in self._read_buffers():
             # [(string, encoding, span, is_interesting), ] \
-            result = b2s.extract_all_strings(buffer, min_chars=self._min_chars, only_interesting=self._only_interesting)
-            # only keep the strings from the result list using map
-            result = list(map(lambda x: x[0], result))
-            # remove duplicates
-            result = list(set(result))
-            # remove all strings that match a set of keywords
-            result = list(filter(lambda x: not any([keyword in x.lower() for keyword in self.CYTHON_KEYWORDS]), result))
-            return result
+            for extracted in b2s.extract_all_strings(buffer, min_chars=self._min_chars,
+                                                     only_interesting=self._only_interesting):
+                string = extracted[0]
+                # remove duplicates, keeping the order in which the strings occur in the file
+                if string in seen:
+                    continue
+                seen.add(string)
+                # remove all strings that match a set of keywords
+                if not self._CYTHON_KEYWORDS_RE.search(string):
+                    result.append(string)
+        return result
 
     def _get_comments(self, in_strings: list[str]) -> list[str]:
         """
@@ -120,7 +200,7 @@ class Cython2Skeleton:
         :param in_strings:
         :return:
         """
-        return list(filter(lambda x: any([keyword in x.lower() for keyword in self.COMMENT_KEYWORDS]), in_strings))
+        return [x for x in in_strings if self._COMMENT_KEYWORDS_RE.search(x)]
 
     def _get_python_symbolpaths(self, in_strings: list[str]):
         """
@@ -129,28 +209,37 @@ class Cython2Skeleton:
         The dot separates package paths and the class name and the function name
         Each symbol name must at least occur twice in the list of strings
         """
+        # all filters are applied in a single pass over the strings:
         # 1.) filter for strings that contain at least one dot, but don't start with a dot
-        symbol_candidates = filter(lambda x: "." in x and not x.startswith("."), in_strings)
-
         # 2.) comprise only dots, underscores, letters and numbers
-        symbol_candidates = list(
-            filter(lambda x: all([c.isalnum() or c == "." or c == "_" for c in x]), symbol_candidates))
-
         # 3.) remove all strings that match a set of elf keywords
-        symbol_candidates = list(
-            filter(lambda x: not any([keyword in x.lower() for keyword in self.ELF_KEYWORDS]), symbol_candidates))
-
         # 4.) if V1.1.1 is not a symbolpath, remove it, when it comprises only numbers and dots and the digit v or V
-        symbol_candidates = list(filter(
-            lambda x: not (x.startswith("v") or x.startswith("V")) and not all([c.isdigit() or c == "." for c in x]),
-            symbol_candidates))
+        symbol_candidates = [
+            x for x in in_strings
+            if "." in x and not x.startswith(".")
+            and not self._INVALID_SYMBOL_CHAR_RE.search(x)
+            and not self._ELF_KEYWORDS_RE.search(x)
+            and not self._VERSION_RE.match(x)
+        ]
 
         # 4.) now remove all strings that occur within other strings
-        unique_symbol_candidates = []
+        if not symbol_candidates:
+            return []
+        # an aho-corasick automaton over all candidates finds every candidate contained in a string in one scan
+        automaton = ahocorasick.Automaton()
         for symbol in symbol_candidates:
-            if not any([symbol in other_symbol for other_symbol in symbol_candidates if other_symbol != symbol]):
-                unique_symbol_candidates.append(symbol)
-        return unique_symbol_candidates
+            automaton.add_word(symbol, symbol)
+        automaton.make_automaton()
+        contained_symbols = set()
+        # containment is transitive, so it is sufficient to scan the strings not contained in any other.
+        # scanning the longest strings first marks the contained ones before they are reached, so they are skipped
+        for symbol in sorted(symbol_candidates, key=len, reverse=True):
+            if symbol in contained_symbols:
+                continue
+            for _, found_symbol in automaton.iter(symbol):
+                if found_symbol != symbol:
+                    contained_symbols.add(found_symbol)
+        return [symbol for symbol in symbol_candidates if symbol not in contained_symbols]
 
     def _create_symbol_tree(self, in_strings: list[str]) -> dict[str:any]:
         """
@@ -165,7 +254,11 @@ class Cython2Skeleton:
             keys = item.split('.')
             current_dict = tree
             for key in keys:
-                current_dict = current_dict.setdefault(key, {})
+                # unlike setdefault, only allocate a new dict when the key is missing
+                next_dict = current_dict.get(key)
+                if next_dict is None:
+                    next_dict = current_dict[key] = {}
+                current_dict = next_dict
         return tree
 
     def _determine_type(self, key):
@@ -176,7 +269,7 @@ class Cython2Skeleton:
         """
         # if 'manager' in key:
         #    return PythonEntityType.CLASS
-        if '__init__' in key or '__new__' in key:
+        if key in self.CONSTRUCTOR_NAMES:
             return PythonEntityType.METHOD
         else:
             return PythonEntityType.UNKNOWN
@@ -191,14 +284,15 @@ class Cython2Skeleton:
         # 1.) convert to python entities
         # 2.) use _determine_type to determine the type of each entity.
         # If a method is found, the parent is a class and so on
-        q = queue.Queue()
+        q = deque()
         root = PythonEntity('root', PythonEntityType.ROOT_TRAVERSAL_OBJECT, '', [], None, [])
-        q.put((root, symbol_tree))
+        q.append((root, symbol_tree))
 
-        while not q.empty():
-            parent_entity, node_dict = q.get()
+        determine_type = self._determine_type
+        while q:
+            parent_entity, node_dict = q.popleft()
             for child_key, child_dict in node_dict.items():
-                child_entity = PythonEntity(child_key, self._determine_type(child_key), '', [], parent_entity, [])
+                child_entity = PythonEntity(child_key, determine_type(child_key), '', [], parent_entity, [])
                 parent_entity.children.append(child_entity)
 
                 # if a method is found, the parent is a class and so on
@@ -213,14 +307,15 @@ class Cython2Skeleton:
                             tmp_parent.type = PythonEntityType.PACKAGE
                             tmp_parent = tmp_parent.parent
 
-                q.put((child_entity, child_dict))
+                q.append((child_entity, child_dict))
 
             # if a class is found, assign all children the type of PythonEntityType.METHOD
             if parent_entity.type == PythonEntityType.CLASS:
                 # assign all children the type of PythonEntityType.METHOD
                 for child in parent_entity.children:
                     child.type = PythonEntityType.METHOD
-            parent_entity.children.sort()
+            # sort by name with a C implemented key, instead of calling PythonEntity.__lt__ per comparison
+            parent_entity.children.sort(key=_NAME_KEY)
 
         return root
 
@@ -246,45 +341,63 @@ class Cython2Skeleton:
         self._shared_libs = list(filter(lambda x: x.endswith(".so") or ".so." in x, strings))
         self._py_files = list(filter(lambda x: x.endswith(".py") or x.endswith(".pyx"), strings))
 
-    def _print_tree(self, node, level, file, print_unknown: bool = False):
+    def _iter_tree_lines(self, root, print_unknown: bool = False) -> Iterator[str]:
         """
-        print the current level and call function recursively for all children
-        :param node:
-        :param level:
-        :param file:
+        yield the lines of the tree in pre-order, iterating with an explicit stack instead of recursion.
+        The lines are generated lazily, so they can be streamed into a file without building the whole output
+        :param root:
+        :param print_unknown:
         :return:
         """
-        indent = '--' * level
-        if not print_unknown:
-            if node.type == PythonEntityType.UNKNOWN:
-                return  # don't print unknown nodes
-
-        file.write(f'{indent}{node.name} - Type: {node.type.name}\n')
-        for child in node.children:
-            self._print_tree(child, level + 1, file, print_unknown)
-
-    def persist_pseudo_skeleton(self, target_filepath: str, print_unknown: bool = False,
+        stack = [(root, '')]
+        while stack:
+            node, indent = stack.pop()
+            if not print_unknown:
+                if node.type == PythonEntityType.UNKNOWN:
+                    continue  # don't print unknown nodes
+
+            yield f'{indent}{node.name} - Type: {node.type.name}\n'
+            # the indent of the children is built once and shared by all of them.
+            # push the children in reverse, so they are popped in their original order
+            child_indent = indent + '--'
+            stack.extend((child, child_indent) for child in reversed(node.children))
+
+    def persist_pseudo_skeleton(self, target_filepath: str | TextIO, print_unknown: bool = False,
                                 store_all_strings: bool = False):
         """
         Persist the pseudo skeleton to a file
-        :param target_filepath: the path to the target file
+        :param target_filepath: the path to the target file or an already opened text file, which is not closed
+        :param print_unknown: print unknown nodes
+        :param store_all_strings: store all strings in the skeleton file,
+            not only the ones that are related to a python entity type
+        """
+        if hasattr(target_filepath, "write"):
+            self._write_pseudo_skeleton(target_filepath, print_unknown, store_all_strings)
+            return
+        # write through a large buffer, so the many small writes below result in few write syscalls
+        with open(target_filepath, "w", buffering=self.WRITE_BUFFER_SIZE, encoding="utf-8") as f:
+            self._write_pseudo_skeleton(f, print_unknown, store_all_strings)
+
+    def _write_pseudo_skeleton(self, f: TextIO, print_unknown: bool, store_all_strings: bool):
+        """
+        Write the pseudo skeleton to an opened text file
+        :param f: the opened text file
         :param print_unknown: print unknown nodes
         :param store_all_strings: store all strings in the skeleton file,
             not only the ones that are related to a python entity type
         """
-        with open(target_filepath, "w") as f:
-            f.write(f"Extracted info for cython file {self._filepath}:\n\n")
-            f.write("\n\n--------------\nSKELETON:\n\n")
-            self._print_tree(self._skeleton, 0, f, print_unknown)
-            f.write("\n\n--------------\nCOMMENTS:\n\n")
-            f.write("\n".join(self._comments))
-            f.write("\n\n--------------\nSHARED_LIBS:\n\n")
-            f.write("\n".join(self._shared_libs))
-            f.write("\n\n--------------\nPY_FILES:\n\n")
-            f.write("\n".join(self._py_files))
-            if store_all_strings:
-                f.write("\n\n--------------\nARBITRARY_STRINGS:\n\n")
-                f.write("\n".join(self._arbitrary_strings))
+        f.write(f"Extracted info for cython file {self._filepath}:\n\n")
+        f.write("\n\n--------------\nSKELETON:\n\n")
+        f.writelines(self._iter_tree_lines(self._skeleton, print_unknown))
+        f.write("\n\n--------------\nCOMMENTS:\n\n")
+        f.write("\n".join(self._comments))
+        f.write("\n\n--------------\nSHARED_LIBS:\n\n")
+        f.write("\n".join(self._shared_libs))
+        f.write("\n\n--------------\nPY_FILES:\n\n")
+        f.write("\n".join(self._py_files))
+        if store_all_strings:
+            f.write("\n\n--------------\nARBITRARY_STRINGS:\n\n")
+            f.write("\n".join(self._arbitrary_strings))
 
     def run_and_store(self, target_filepath: str, print_unknown: bool = False,
                       store_all_strings: bool = False):
@@ -297,6 +410,7 @@ class Cython2Skeleton:
         """
         self.process()
         self.persist_pseudo_skeleton(target_filepath, print_unknown, store_all_strings)
+        self.close()
 
 
 if __name__ == "__main__":
@@ -1,15 +1,300 @@
+import functools
+import multiprocessing
 import os
-import pathlib
-from typing import Optional
+import queue
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from typing import Iterable, Iterator, Optional, Sequence, TypeVar
 
 import fire
 
-from src.cython2skeleton import Cython2Skeleton
+from src.cython2skeleton import Cython2Skeleton, __version__
+
+SKELETON_SUFFIX = ".skel"
+FINGERPRINT_SUFFIX = ".fp"
+# output of previous runs: skeleton and fingerprint files and temporary files left by interrupted runs
+_OUTPUT_FILENAME_RE = re.compile(r"\.skel(?:\.fp)?(?:\.tmp\.\d+)?\Z")
+# magic bytes at the start of ELF, PE and (universal) Mach-O files
+_BINARY_MAGICS = (b"\x7fELF", b"MZ", b"\xcf\xfa\xed\xfe", b"\xce\xfa\xed\xfe", b"\xfe\xed\xfa\xcf",
+                  b"\xfe\xed\xfa\xce", b"\xca\xfe\xba\xbe")
+# maximum number of planned files buffered between the directory walk and the processing
+WALK_QUEUE_SIZE = 1024
+
+T = TypeVar("T")
+
+
+def _iter_files(directory: str, excluded_dir: Optional[os.stat_result] = None) -> Iterator[os.DirEntry]:
+    """
+    Recursively yields the files within a directory.
+    Uses os.scandir, whose entries already know their type, so no additional stat call is needed per file.
+    Like os.walk, unreadable directories are skipped and symlinks to directories are not followed
+
+    :param directory: directory to traverse through
+    :param excluded_dir: stat result of a directory that is not traversed, e.g. the target directory
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # the inode is known from the directory listing, the device is only compared if the inode matches
+                if (excluded_dir is not None and entry.inode() == excluded_dir.st_ino
+                        and entry.stat(follow_symlinks=False).st_dev == excluded_dir.st_dev):
+                    continue
+                yield from _iter_files(entry.path, excluded_dir)
+            elif entry.is_file():
+                yield entry
+
+
+def _looks_binary(filepath: str) -> bool:
+    """
+    Checks the magic bytes of a file, to tell executables and shared libraries apart from all other files.
+    Reads only the first bytes, so other files are skipped without processing them
+
+    :param filepath: path to the file
+    """
+    try:
+        with open(filepath, "rb") as f:
+            return f.read(4).startswith(_BINARY_MAGICS)
+    except OSError:
+        return False
+
+
+def _iter_in_background(iterable: Iterable[T], maxsize: int = WALK_QUEUE_SIZE) -> Iterator[T]:
+    """
+    Consumes an iterable within a background thread and yields its items through a bounded queue.
+    Used for the directory walk, so listing directories continues while the files are processed,
+    without buffering more than maxsize items. Exceptions of the iterable are raised in the consuming thread
+
+    :param iterable: iterable to consume in the background
+    :param maxsize: maximum number of items buffered in the queue
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    return
+                items.put((item, None))
+            items.put((end, None))
+        except BaseException as e:
+            items.put((end, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        # if the consumer stops early, unblock the producer so it can notice and finish
+        stopped.set()
+        while not items.empty():
+            items.get_nowait()
+
+
+def _prefetch(filepath: str):
+    """
+    Asks the kernel to read a file into the page cache in the background,
+    so it is already cached once a worker processes it.
+    Does nothing on platforms without posix_fadvise or if the file can't be opened
+
+    :param filepath: path to the file to prefetch
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _fingerprint(filepath: str, print_unknown: bool, store_all_strings: bool, only_interesting: bool,
+                 min_chars: int) -> str:
+    """
+    Fingerprint of everything the quasi skeleton of a file depends on:
+    the size and modification time of the file, the version of cython2skeleton and the options
+
+    :param filepath: path to the cython compiled file
+    :return: the fingerprint
+    """
+    st = os.stat(filepath)
+    return " ".join(map(str, (st.st_size, st.st_mtime_ns, __version__,
+                              print_unknown, store_all_strings, only_interesting, min_chars)))
+
+
+def _is_up_to_date(target_filepath: str, fingerprint: str) -> bool:
+    """
+    Checks whether the quasi skeleton file exists and was created from an input with the given fingerprint
+
+    :param target_filepath: path of the quasi skeleton file
+    :param fingerprint: fingerprint of the input file and options
+    """
+    if not os.path.exists(target_filepath):
+        return False
+    try:
+        with open(target_filepath + FINGERPRINT_SUFFIX, encoding="utf-8") as f:
+            return f.read() == fingerprint
+    except OSError:
+        return False
+
+
+def _temporary_filepath(filepath: str) -> str:
+    """
+    Path of the temporary file a file is written to, before it replaces the file at once.
+    Contains the process id, so workers writing to the same directory never share a temporary file
+
+    :param filepath: path of the file
+    """
+    return f"{filepath}.tmp.{os.getpid()}"
+
+
+def _store_fingerprint(target_filepath: str, fingerprint: str):
+    """
+    Stores the fingerprint next to the quasi skeleton file.
+    It is written to a temporary file that replaces the old fingerprint at once, so it is never stored partially
+
+    :param target_filepath: path of the quasi skeleton file
+    :param fingerprint: fingerprint of the input file and options
+    """
+    fingerprint_filepath = target_filepath + FINGERPRINT_SUFFIX
+    tmp_filepath = _temporary_filepath(fingerprint_filepath)
+    with open(tmp_filepath, "w", encoding="utf-8") as f:
+        f.write(fingerprint)
+    os.replace(tmp_filepath, fingerprint_filepath)
+
+
+def iter_inputs(src_dir: str, searched_file_extensions: Optional[str | Sequence[str]] = None,
+                excluded_dir: Optional[str] = None) -> Iterator[str]:
+    """
+    Lazily yields the paths of the files to process, while the source directory is traversed
+
+    :param src_dir: directory to traverse through
+    :param searched_file_extensions: comma separated list of file extensions to filter for e.g. "so,elf" or ".so,.elf".
+        If None, all ELF, PE and Mach-O files are yielded, recognized by their magic bytes
+    :param excluded_dir: directory that is not traversed, e.g. the target directory if it is within src_dir
+    :return: paths of the files
+    """
+    # parse the extensions once, with and without leading dot, e.g. "so,elf" or ".so,.elf".
+    # fire already splits comma separated command line values into a tuple
+    extensions = None
+    if searched_file_extensions:
+        if isinstance(searched_file_extensions, str):
+            searched_file_extensions = searched_file_extensions.split(",")
+        extensions = frozenset("." + extension.strip().lstrip(".") for extension in searched_file_extensions)
+    excluded_stat = os.stat(excluded_dir) if excluded_dir and os.path.isdir(excluded_dir) else None
+    # local name for the function called per entry, to avoid the global and attribute lookups in the loop
+    splitext = os.path.splitext
+    for entry in _iter_files(src_dir, excluded_stat):
+        filename = entry.name
+        # skip the output of previous runs and files with other extensions, before the path of the entry is built
+        if (_OUTPUT_FILENAME_RE.search(filename)
+                or extensions is not None and splitext(filename)[1] not in extensions):
+            continue
+        # without extensions to filter for, only executables and shared libraries are processed
+        if extensions is None and not _looks_binary(entry.path):
+            continue
+        yield entry.path
+
+
+def plan_targets(filepaths: Iterable[str], src_dir: str,
+                 target_dir: Optional[str] = None) -> Iterator[tuple[str, str]]:
+    """
+    Lazily yields the files together with the path their quasi skeleton should be stored at.
+    Creates the target directories on the way
+
+    :param filepaths: paths of the files within src_dir, as yielded by iter_inputs
+    :param src_dir: directory the files were found in
+    :param target_dir: directory where the quasi skeleton files should be stored.
+        If None, the files will be stored in the same directory as the original file, with the extension .skel
+    :return: tuples of (filepath, target_filepath)
+    """
+    # the paths of the files all start with the source directory joined with a separator
+    src_prefix_len = len(os.path.join(src_dir, ""))
+    created_dirs = set()
+    join = os.path.join
+    for filepath in filepaths:
+        if target_dir:
+            target_filepath = join(target_dir, filepath[src_prefix_len:]) + SKELETON_SUFFIX
+            # create every target directory only once, instead of once per file
+            parent = os.path.dirname(target_filepath)
+            if parent not in created_dirs:
+                os.makedirs(parent, exist_ok=True)
+                created_dirs.add(parent)
+        else:
+            target_filepath = filepath + SKELETON_SUFFIX
+        yield filepath, target_filepath
+
+
+def process_one(filepath: str, target_filepath: str, fingerprint: Optional[str] = None, print_unknown: bool = True,
+                store_all_strings: bool = False, only_interesting: bool = False, min_chars: int = 5):
+    """
+    Reconstructs the quasi skeleton of a single cython compiled file and stores it together with its fingerprint.
+    Defined at module level, so it can be pickled and executed in a worker process
+
+    :param filepath: path to the cython compiled file
+    :param target_filepath: path where the quasi skeleton file should be stored
+    :param fingerprint: fingerprint of the input file and options, stored once the quasi skeleton is written.
+        If None, no fingerprint is stored
+    :param print_unknown: print strings that could be from python but are not mapped to a python entity type
+    :param store_all_strings: store all strings in the skeleton file, not only the ones that are related to a python entity type
+    :param only_interesting: only strings that are considered interesting by binary2strings are processed
+    :param min_chars: only store strings that are longer than min_chars
+    """
+    c2s = Cython2Skeleton(filepath, only_interesting=only_interesting, min_chars=min_chars)
+    try:
+        c2s.process()
+        # write to a temporary file that replaces the skeleton file at once,
+        # so an interrupted run never leaves a partially written skeleton file behind
+        tmp_filepath = _temporary_filepath(target_filepath)
+        try:
+            with open(tmp_filepath, "w", buffering=Cython2Skeleton.WRITE_BUFFER_SIZE, encoding="utf-8") as f:
+                c2s.persist_pseudo_skeleton(f, print_unknown=print_unknown, store_all_strings=store_all_strings)
+            os.replace(tmp_filepath, target_filepath)
+        except BaseException:
+            if os.path.exists(tmp_filepath):
+                os.unlink(tmp_filepath)
+            raise
+    finally:
+        c2s.close()
+    if fingerprint is not None:
+        _store_fingerprint(target_filepath, fingerprint)
+
+
+def _with_fingerprints(tasks: Iterator[tuple[str, str]], print_unknown: bool, store_all_strings: bool,
+                       only_interesting: bool, min_chars: int, force: bool) -> Iterator[tuple[str, str, str]]:
+    """
+    Adds the fingerprint to the planned files and drops the files whose quasi skeleton is up to date
+
+    :param tasks: tuples of (filepath, target_filepath)
+    :param force: keep all files, even if their quasi skeleton is up to date
+    :return: tuples of (filepath, target_filepath, fingerprint)
+    """
+    for filepath, target_filepath in tasks:
+        fingerprint = _fingerprint(filepath, print_unknown, store_all_strings, only_interesting, min_chars)
+        if force or not _is_up_to_date(target_filepath, fingerprint):
+            yield filepath, target_filepath, fingerprint
 
 
 def traverse_through_directroy(src_dir: str, target_dir: Optional[str] = None, print_unknown: bool = True,
-                               searched_file_extensions: Optional[str] = None, store_all_strings: bool = False,
-                                only_interesting: bool = False, min_chars: int = 5
+                               searched_file_extensions: Optional[str | Sequence[str]] = None,
+                               store_all_strings: bool = False, only_interesting: bool = False, min_chars: int = 5,
+                               max_workers: Optional[int] = None, force: bool = False, verbose: bool = False
                                ):
     """
     Traverses through a directory and retrieves as many info about the orig python from
@@ -19,36 +304,55 @@ def traverse_through_directroy(src_dir: str, target_dir: Optional[str] = None, p
     :param target_dir: directory where the quasi skeleton files should be stored.
         If None, the files will be stored in the same directory as the original file, with the extension .skel
     :param print_unknown: print strings that could be from python but are not mapped to a python entity type
-    :param searched_file_extensions: comma separated list of filenames to filter for e.g. ".so,.elf"
+    :param searched_file_extensions: comma separated list of file extensions to filter for e.g. "so,elf" or ".so,.elf".
+        If None, all ELF, PE and Mach-O files are processed, recognized by their magic bytes
     :param store_all_strings: store all strings in the skeleton file, not only the ones that are related to a python entity type
     :param only_interesting: only strings that are considered interesting by binary2strings are processed
     :param min_chars: only store strings that are longer than min_chars
+    :param max_workers: number of processes the files are distributed over. Defaults to the number of cpu cores,
+        with 1 the files are processed within the current process
+    :param force: process all files, even if their quasi skeleton file is up to date.
+        By default files are skipped, if neither the file, the options nor the version of cython2skeleton changed
+    :param verbose: print the path of every processed file
     :return:
     """
-    for root, dirs, files in os.walk(src_dir):
-        for filename in files:
-
-            if searched_file_extensions:
-                if filename not in searched_file_extensions.split(","):
-                    continue
+    if target_dir:
+        # create the target directory before the walk, so it can be excluded, if it is within the source directory
+        os.makedirs(target_dir, exist_ok=True)
+    # the stages of the pipeline are generators, so files are planned while the directory is still traversed
+    inputs = iter_inputs(src_dir, searched_file_extensions, excluded_dir=target_dir)
+    tasks = _iter_in_background(plan_targets(inputs, src_dir, target_dir))
+    tasks = _with_fingerprints(tasks, print_unknown, store_all_strings, only_interesting, min_chars, force)
+    # every file is processed independently, so the files are distributed over a pool of processes
+    process = functools.partial(process_one, print_unknown=print_unknown, store_all_strings=store_all_strings,
+                                only_interesting=only_interesting, min_chars=min_chars)
+    if max_workers == 1:
+        for filepath, target_filepath, fingerprint in tasks:
+            if verbose:
+                print(filepath)
+            process(filepath, target_filepath, fingerprint)
+        return
 
-            if filename.endswith(".skel"):
-                continue
-            print(os.path.join(root, filename))
-            c2s = Cython2Skeleton(os.path.join(root, filename), only_interesting=only_interesting, min_chars=min_chars)
-            c2s.process()
-            if target_dir:
-                target_dir = pathlib.Path(target_dir)
-                orig_path = pathlib.Path(os.path.join(root, filename))
-                rel_path = orig_path.relative_to(src_dir)
-                p = target_dir / rel_path
-                p.parent.mkdir(parents=True, exist_ok=True)
-                target_filepath = str(p) + ".skel"
-            else:
-                target_filepath = os.path.join(root, filename) + ".skel"
-
-            c2s.persist_pseudo_skeleton(target_filepath, print_unknown=print_unknown,
-                                        store_all_strings=store_all_strings)
+    # files are submitted while the directory is still traversed, so the walk overlaps with the processing.
+    # the number of pending files is bounded, so a huge tree is not queued up in memory at once
+    max_pending = 2 * (max_workers or os.cpu_count() or 1)
+    # the directory walk runs in a background thread, so the workers must not be forked from this process
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)) as executor:
+        pending = set()
+        for filepath, target_filepath, fingerprint in tasks:
+            if verbose:
+                print(filepath)
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # get the results, so that exceptions raised within a worker are propagated
+                for future in done:
+                    future.result()
+            # the file waits in the queue of the pool, meanwhile the kernel can read it ahead
+            _prefetch(filepath)
+            pending.add(executor.submit(process, filepath, target_filepath, fingerprint))
+        for future in as_completed(pending):
+            future.result()
 
 
 if __name__ == "__main__":